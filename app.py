@@ -1,7 +1,13 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, abort
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
-from sqlalchemy.orm import DeclarativeBase, relationship, Mapped, mapped_column
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    relationship,
+    Mapped,
+    mapped_column,
+)
 from sqlalchemy import (
     ForeignKey,
     Table,
@@ -10,11 +16,21 @@ from sqlalchemy import (
     Date,
     Float,
     select,
+    update,
+    delete,
+    func,
 )
+from sqlalchemy.pool import NullPool
 from marshmallow import ValidationError, fields
-from typing import List
+from typing import Annotated, List
 from datetime import date
+from functools import lru_cache
 import os
+import hashlib
+import time
+import click
+import msgspec
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -23,8 +39,26 @@ db_user = os.getenv("DB_USER")
 db_password = os.getenv("DB_PASSWORD")
 
 
+# json provider backed by orjson, used by jsonify and schema.jsonify,
+# non str keys are allowed since marshmallow errors key list items by index
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            mimetype="application/json",
+        )
+
+
 # initialize flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # mysql database config
 app.config["SQLALCHEMY_DATABASE_URI"] = (
@@ -32,6 +66,22 @@ app.config["SQLALCHEMY_DATABASE_URI"] = (
 )
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# connection pool config, every gunicorn worker builds its own engine so size
+# it per process, pool_size >= threads per worker, the server then sees about
+# workers x threads connections which has to fit under MySQL max_connections
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 20,
+    "max_overflow": 20,
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+}
+
+# behind a TCP load balancer or autoscaling, idle pooled connections just hold
+# server resources, so DB_NULL_POOL=1 opens and closes one per request instead
+if os.getenv("DB_NULL_POOL", "").lower() in ("1", "true"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"poolclass": NullPool}
+
 
 # base model
 class Base(DeclarativeBase):
@@ -48,7 +98,8 @@ order_product = Table(
     "order_product",
     Base.metadata,
     Column("order_id", ForeignKey("order.id"), primary_key=True),
-    Column("product_id", ForeignKey("product.id"), primary_key=True),
+    # product_id index serves product-first lookups the composite pk can't
+    Column("product_id", ForeignKey("product.id"), primary_key=True, index=True),
 )
 
 
@@ -59,9 +110,11 @@ class User(Base):
     name: Mapped[str] = mapped_column(String(50), nullable=False)
     address: Mapped[str] = mapped_column(String(200), nullable=False)
     email: Mapped[str] = mapped_column(String(100), unique=True)
+    # bumped on every update, feeds the ETag on GET routes
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
 
-    # creates one to many relationship to Order
-    order: Mapped[List["Order"]] = relationship(back_populates="user")
+    # creates one to many relationship to Order, never read on hot endpoints
+    order: Mapped[List["Order"]] = relationship(back_populates="user", lazy="raise")
 
 
 class Product(Base):
@@ -69,10 +122,12 @@ class Product(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     product_name: Mapped[str] = mapped_column(String(100), nullable=False)
     price: Mapped[float] = mapped_column(Float, nullable=False)
+    # bumped on every update, feeds the ETag on GET routes
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
 
-    # creates many to many relationship to Order
+    # creates many to many relationship to Order, never read on hot endpoints
     order: Mapped[List["Order"]] = relationship(
-        secondary=order_product, back_populates="product"
+        secondary=order_product, back_populates="product", lazy="raise"
     )
 
 
@@ -80,25 +135,28 @@ class Order(Base):
     __tablename__ = "order"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     order_date: Mapped[date] = mapped_column(Date, nullable=False)
-    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), index=True)
 
     # creates many to one relationship to user table
     user: Mapped["User"] = relationship(back_populates="order")
 
-    # creates many to many relationship to Product through secondary
+    # creates many to many relationship to Product through secondary,
+    # order routes query order_product directly so it's never read either
     product: Mapped[List["Product"]] = relationship(
-        secondary=order_product, back_populates="order"
+        secondary=order_product, back_populates="order", lazy="raise"
     )
 
 
 class UserSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = User
+        exclude = ("version",)
 
 
 class ProductSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Product
+        exclude = ("version",)
 
 
 class OrderSchema(ma.SQLAlchemyAutoSchema):
@@ -117,33 +175,94 @@ order_schema = OrderSchema()
 orders_schema = OrderSchema(many=True)
 
 
+# POST and PUT bodies are decoded and validated in one pass by msgspec,
+# the marshmallow schemas above only shape responses for these routes
+class UserInput(msgspec.Struct, forbid_unknown_fields=True):
+    name: Annotated[str, msgspec.Meta(max_length=50)]
+    address: Annotated[str, msgspec.Meta(max_length=200)]
+    email: Annotated[str, msgspec.Meta(max_length=100)]
+
+
+class ProductInput(msgspec.Struct, forbid_unknown_fields=True):
+    product_name: Annotated[str, msgspec.Meta(max_length=100)]
+    price: float
+
+
+class OrderInput(msgspec.Struct, forbid_unknown_fields=True):
+    order_date: date
+    user_id: int
+
+
+# capped so one request can't build an unbounded IN list and multi row INSERT
+class ProductIdsInput(msgspec.Struct, forbid_unknown_fields=True):
+    product_ids: Annotated[list[int], msgspec.Meta(min_length=1, max_length=1000)]
+
+
+user_decoder = msgspec.json.Decoder(UserInput)
+product_decoder = msgspec.json.Decoder(ProductInput)
+order_decoder = msgspec.json.Decoder(OrderInput)
+product_ids_decoder = msgspec.json.Decoder(ProductIdsInput)
+
+
+# decodes the request body, non json content types get the same 415
+# request.json gives
+def decode_body(decoder):
+    if not request.is_json:
+        abort(415)
+
+    return decoder.decode(request.get_data())
+
+
+# lets clients reuse a GET response until its ETag changes, shared proxies
+# only get to cache it when public, so keep personal data private
+def cache_response(response, etag, public=True, max_age=30):
+    response.set_etag(etag)
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    return response
+
+
+def make_etag(*parts):
+    return hashlib.blake2b(repr(parts).encode(), digest_size=8).hexdigest()
+
+
 # retrieves all users
 @app.route("/users", methods=["GET"])
 def get_users():
-    query = select(User)
-    users = db.session.execute(query).scalars().all()
+    # plain column rows, skips ORM object and schema overhead per user
+    query = select(User.id, User.name, User.address, User.email)
+    users = db.session.execute(query).mappings().all()
 
-    return users_schema.jsonify(users, many=True), 200
+    return jsonify([dict(user) for user in users]), 200
 
 
 # retrieves one user by id
 @app.route("/users/<int:id>", methods=["GET"])
 def get_user(id):
     user = db.session.get(User, id)  # get users
+    if not user:
+        return user_schema.jsonify(user), 200
 
-    return user_schema.jsonify(user), 200
+    etag = make_etag(user.id, user.version)
+    if request.if_none_match.contains(etag):
+        return cache_response(app.response_class(status=304), etag, public=False)
+
+    return cache_response(user_schema.jsonify(user), etag, public=False), 200
 
 
 # create new user
 @app.route("/users", methods=["POST"])
 def create_user():
     try:
-        user_data = user_schema.load(request.json)
-    except ValidationError as e:
-        return jsonify(e.messages), 400
+        user_data = decode_body(user_decoder)
+    except msgspec.DecodeError as e:
+        return jsonify({"error": str(e)}), 400
 
     new_user = User(
-        name=user_data["name"], email=user_data["email"], address=user_data["address"]
+        name=user_data.name, email=user_data.email, address=user_data.address
     )
     db.session.add(new_user)
     db.session.commit()
@@ -154,65 +273,117 @@ def create_user():
 # update user by id PUT
 @app.route("/users/<int:id>", methods=["PUT"])
 def update_user(id):
-    user = db.session.get(User, id)
-    if not user:
-        return jsonify({"message": "Invalid user id"}), 404
-
     try:
-        user_data = user_schema.load(request.json)
-    except ValidationError as e:
-        return jsonify(e.messages), 400
+        user_data = msgspec.structs.asdict(decode_body(user_decoder))
+    except msgspec.DecodeError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # single UPDATE, rowcount tells us whether the user exists
+    query = (
+        update(User)
+        .where(User.id == id)
+        .values(**user_data, version=User.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    result = db.session.execute(query)
+    db.session.commit()
 
-    user.name = user_data["name"]
-    user.email = user_data["email"]
+    if result.rowcount == 0:
+        return jsonify({"message": "Invalid user id"}), 404
 
-    db.session.commit()
-    return user_schema.jsonify(user), 200
+    return user_schema.jsonify({"id": id, **user_data}), 200
 
 
 # delete user by id DELETE
 @app.route("/users/<int:id>", methods=["DELETE"])
 def delete_user(id):
-    user = db.session.get(User, id)
+    query = (
+        delete(User)
+        .where(User.id == id)
+        .execution_options(synchronize_session=False)
+    )
+    result = db.session.execute(query)
+    db.session.commit()
 
-    if not user:
+    if result.rowcount == 0:
         return jsonify({"error": "User not found"}), 404
 
-    db.session.delete(user)
-    db.session.commit()
     return jsonify({"message": f"successfully deleted user {id}"}), 200
 
 
 # retrieves all products GET
 @app.route("/products", methods=["GET"])
 def get_products():
-    query = select(Product)
-    products = db.session.execute(query).scalars().all()
+    # count, newest id and version total change on any insert, update or delete
+    state = select(func.count(), func.max(Product.id), func.sum(Product.version))
+    etag = make_etag(*db.session.execute(state).one())
+    if request.if_none_match.contains(etag):
+        return cache_response(app.response_class(status=304), etag)
+
+    query = select(Product.id, Product.product_name, Product.price)
+    products = db.session.execute(query).mappings().all()
 
-    return products_schema.jsonify(products, many=True), 200
+    return cache_response(jsonify([dict(product) for product in products]), etag), 200
+
+
+# encoded product row, None when the id doesn't exist
+def product_blob(id):
+    query = select(Product.id, Product.product_name, Product.price).where(
+        Product.id == id
+    )
+    product = db.session.execute(query).mappings().first()
+
+    return orjson.dumps(dict(product)) if product else None
+
+
+# opt in per process cache of encoded products, PRODUCT_CACHE=1. writes only
+# clear the process that handled them, so with more than one worker the others
+# keep serving old or deleted products, leave it off unless GUNICORN_WORKERS=1.
+# even then a read that queried before a write's commit can put the old row
+# back, so a product may be up to one time bucket stale
+PRODUCT_CACHE = os.getenv("PRODUCT_CACHE", "").lower() in ("1", "true")
+PRODUCT_CACHE_TTL = 30
+
+
+@lru_cache(maxsize=4096)
+def cached_product_blob(id, bucket):
+    return product_blob(id)
 
 
 # retrieves one product by id GET
 @app.route("/products/<int:id>", methods=["GET"])
 def get_product(id):
-    product = db.session.get(Product, id)
+    if PRODUCT_CACHE:
+        blob = cached_product_blob(id, int(time.monotonic() // PRODUCT_CACHE_TTL))
+    else:
+        blob = product_blob(id)
+    if blob is None:
+        return jsonify({}), 200
+
+    etag = make_etag(blob)
+    if request.if_none_match.contains(etag):
+        return cache_response(
+            app.response_class(status=304), etag, max_age=PRODUCT_CACHE_TTL
+        )
 
-    return product_schema.jsonify(product), 200
+    response = app.response_class(blob, mimetype="application/json")
+    return cache_response(response, etag, max_age=PRODUCT_CACHE_TTL), 200
 
 
 # create new product POST
 @app.route("/products", methods=["POST"])
 def create_product():
     try:
-        product_data = product_schema.load(request.json)
-    except ValidationError as e:
-        return jsonify(e.messages), 400
+        product_data = decode_body(product_decoder)
+    except msgspec.DecodeError as e:
+        return jsonify({"error": str(e)}), 400
 
     new_product = Product(
-        product_name=product_data["product_name"], price=product_data["price"]
+        product_name=product_data.product_name, price=product_data.price
     )
     db.session.add(new_product)
     db.session.commit()
+    cached_product_blob.cache_clear()
 
     return product_schema.jsonify(new_product), 201
 
@@ -220,32 +391,45 @@ def create_product():
 # update product by id PUT /products/<id>
 @app.route("/products/<int:id>", methods=["PUT"])
 def update_product(id):
-    product = db.session.get(Product, id)
-    if not product:
-        return jsonify({"message": "Invalid product id"}), 404
-
     try:
-        product_data = product_schema.load(request.json)
-    except ValidationError as e:
-        return jsonify(e.messages), 400
+        product_data = msgspec.structs.asdict(decode_body(product_decoder))
+    except msgspec.DecodeError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # single UPDATE, rowcount tells us whether the product exists
+    query = (
+        update(Product)
+        .where(Product.id == id)
+        .values(**product_data, version=Product.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    result = db.session.execute(query)
+    db.session.commit()
+    cached_product_blob.cache_clear()
 
-    product.product_name = product_data["product_name"]
-    product.price = product_data["price"]
+    if result.rowcount == 0:
+        return jsonify({"message": "Invalid product id"}), 404
 
-    db.session.commit()
-    return product_schema.jsonify(product), 200
+    return product_schema.jsonify({"id": id, **product_data}), 200
 
 
 # delete product by id DELETE /products/<id>
 @app.route("/products/<int:id>", methods=["DELETE"])
 def delete_product(id):
-    product = db.session.get(Product, id)
+    # clear the product out of any orders first so the FK allows the delete
+    db.session.execute(order_product.delete().where(order_product.c.product_id == id))
+    query = (
+        delete(Product)
+        .where(Product.id == id)
+        .execution_options(synchronize_session=False)
+    )
+    result = db.session.execute(query)
+    db.session.commit()
+    cached_product_blob.cache_clear()
 
-    if not product:
+    if result.rowcount == 0:
         return jsonify({"error": "Product not found"}), 404
 
-    db.session.delete(product)
-    db.session.commit()
     return jsonify({"message": f"successfully deleted product {id}"}), 200
 
 
@@ -253,13 +437,11 @@ def delete_product(id):
 @app.route("/orders", methods=["POST"])
 def new_order():
     try:
-        order_data = order_schema.load(request.json)
-    except ValidationError as e:
-        return (jsonify(e.messages), 400)
+        order_data = decode_body(order_decoder)
+    except msgspec.DecodeError as e:
+        return (jsonify({"error": str(e)}), 400)
 
-    new_order = Order(
-        user_id=order_data["user_id"], order_date=order_data["order_date"]
-    )
+    new_order = Order(user_id=order_data.user_id, order_date=order_data.order_date)
 
     db.session.add(new_order)
     db.session.commit()
@@ -270,60 +452,149 @@ def new_order():
 # add product to an order, prevent duplicates
 @app.route("/orders/<int:order_id>/add_product/<int:product_id>", methods=["PUT"])
 def add_product(order_id, product_id):
-    order = db.session.get(Order, order_id)
-    product = db.session.get(Product, product_id)
+    # fetch product name, order existence and membership in one round trip
+    query = (
+        select(Product.product_name, order_product.c.order_id)
+        .select_from(Product)
+        .join(Order, Order.id == order_id)
+        .outerjoin(
+            order_product,
+            (order_product.c.order_id == Order.id)
+            & (order_product.c.product_id == Product.id),
+        )
+        .where(Product.id == product_id)
+    )
+    row = db.session.execute(query).first()
 
     # Check if order or product exists
-    if not order or not product:
+    if not row:
         return jsonify({"error": "Order or Product not found"}), 404
 
+    product_name, existing_order_id = row
+
     # Prevent duplicate product in order
-    if product in order.product:
+    if existing_order_id is not None:
         return jsonify({"message": "Product already in order"}), 400
 
-    order.product.append(product)
+    db.session.execute(
+        order_product.insert().values(order_id=order_id, product_id=product_id)
+    )
     db.session.commit()
 
     return (
-        jsonify({"message": f"Successfully added {product.product_name} to order!"}),
+        jsonify({"message": f"Successfully added {product_name} to order!"}),
         200,
     )
 
 
+# add several products to an order in one request, skips ones already in it
+@app.route("/orders/<int:order_id>/add_products", methods=["PUT"])
+def add_products(order_id):
+    try:
+        product_ids = decode_body(product_ids_decoder).product_ids
+    except msgspec.DecodeError as e:
+        return jsonify({"error": str(e)}), 400
+
+    product_ids = list(dict.fromkeys(product_ids))
+
+    # fetch which products exist and which are already in the order at once
+    query = (
+        select(Product.id, order_product.c.order_id)
+        .select_from(Product)
+        .join(Order, Order.id == order_id)
+        .outerjoin(
+            order_product,
+            (order_product.c.order_id == Order.id)
+            & (order_product.c.product_id == Product.id),
+        )
+        .where(Product.id.in_(product_ids))
+    )
+    rows = db.session.execute(query).all()
+
+    if len(rows) != len(product_ids):
+        return jsonify({"error": "Order or Product not found"}), 404
+
+    new_rows = [
+        {"order_id": order_id, "product_id": product_id}
+        for product_id, existing_order_id in rows
+        if existing_order_id is None
+    ]
+    added = 0
+    if new_rows:
+        # IGNORE skips rows a concurrent request inserted after our SELECT
+        # instead of failing the whole batch on the duplicate primary key
+        query = order_product.insert().prefix_with("IGNORE", dialect="mysql")
+        added = db.session.execute(query, new_rows).rowcount
+        db.session.commit()
+
+    message = f"Successfully added {added} products to order!"
+    return jsonify({"message": message}), 200
+
+
 # remove product from an order
 @app.route("/orders/<int:order_id>/remove_product/<int:product_id>", methods=["DELETE"])
 def remove_product(order_id, product_id):
-    order = db.session.get(Order, order_id)
-    product = db.session.get(Product, product_id)
+    # only drop the association row, the product itself stays
+    result = db.session.execute(
+        order_product.delete().where(
+            order_product.c.order_id == order_id,
+            order_product.c.product_id == product_id,
+        )
+    )
+    db.session.commit()
 
-    if product not in order.product:
+    if result.rowcount == 0:
         return jsonify({"error": "Product not found in order"}), 404
 
-    db.session.delete(product)
-    db.session.commit()
-    return jsonify({"message": f"successfully deleted {product}"}), 200
+    return (
+        jsonify(
+            {
+                "message": f"successfully removed product {product_id} from order {order_id}"
+            }
+        ),
+        200,
+    )
 
 
 # get all orders for a user
 @app.route("/orders/user/<int:user_id>", methods=["GET"])
 def get_user_orders(user_id):
-    query = select(Order).where(Order.user_id == user_id)
-    orders = db.session.execute(query).scalars().all()
+    query = select(Order.id, Order.order_date, Order.user_id).where(
+        Order.user_id == user_id
+    )
+    orders = db.session.execute(query).mappings().all()
 
-    return orders_schema.jsonify(orders, many=True), 200
+    return jsonify([dict(order) for order in orders]), 200
 
 
 # get all products for an order
 @app.route("/orders/<int:order_id>/products", methods=["GET"])
 def get_order_products(order_id):
-    order = db.session.get(Order, order_id)
-    if not order:
-        return jsonify({"error": "Order not found"}), 404
+    # one join straight from the association table to product columns
+    query = (
+        select(Product.id, Product.product_name, Product.price)
+        .join(order_product, order_product.c.product_id == Product.id)
+        .where(order_product.c.order_id == order_id)
+    )
+    products = db.session.execute(query).mappings().all()
+
+    # only an empty result needs to tell a missing order from an empty one
+    if not products:
+        order_exists = db.session.execute(
+            select(Order.id).where(Order.id == order_id)
+        ).first()
+        if not order_exists:
+            return jsonify({"error": "Order not found"}), 404
+
+    return jsonify([dict(product) for product in products]), 200
+
 
-    return products_schema.jsonify(order.product), 200
+# create tables once with `flask --app app init-db` instead of on every boot
+@app.cli.command("init-db")
+def init_db():
+    db.create_all()
+    click.echo("Initialized the database.")
 
 
 if __name__ == "__main__":
-    with app.app_context():
-        db.create_all()
     app.run(debug=True)
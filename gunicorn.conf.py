@@ -0,0 +1,18 @@
+import multiprocessing
+import os
+
+# production server config, run with `gunicorn app:app`
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+
+# one process per core plus one, each with a thread pool, the mysql driver
+# releases the GIL while waiting on the socket so threads overlap queries
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+# keep threads at or below pool_size in app.py, pools are per worker, and keep
+# workers x threads under MySQL max_connections (151 by default), the defaults
+# here pass that from 10 cores up so set GUNICORN_WORKERS there
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+keepalive = 5
+timeout = 30
+graceful_timeout = 30
@@ -0,0 +1,185 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+import app as app_module
+from app import app, db, cached_product_blob
+
+
+# points the app at an in memory sqlite database for each test
+@pytest.fixture
+def client():
+    engine = create_engine(
+        "sqlite://",
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False},
+    )
+    engines = db._app_engines[app]
+    mysql_engine = engines[None]
+    engines[None] = engine
+    cached_product_blob.cache_clear()
+
+    with app.app_context():
+        db.create_all()
+
+    yield app.test_client()
+
+    engines[None] = mysql_engine
+    engine.dispose()
+
+
+def create_user(client, email="a@example.com"):
+    body = {"name": "a", "email": email, "address": "1 Main St"}
+    return client.post("/users", json=body).get_json()["id"]
+
+
+def create_product(client, name="widget", price=2.5):
+    body = {"product_name": name, "price": price}
+    return client.post("/products", json=body).get_json()["id"]
+
+
+def create_order(client, user_id):
+    body = {"user_id": user_id, "order_date": "2024-01-01"}
+    return client.post("/orders", json=body).get_json()["id"]
+
+
+# validation errors are returned before any database access
+def test_add_products_rejects_non_integer_id(client):
+    response = client.put("/orders/1/add_products", json={"product_ids": ["x"]})
+
+    assert response.status_code == 400
+    assert response.get_json() == {
+        "error": "Expected `int`, got `str` - at `$.product_ids[0]`"
+    }
+
+
+def test_add_products_rejects_more_than_1000_ids(client):
+    product_ids = list(range(1, 1002))
+    response = client.put("/orders/1/add_products", json={"product_ids": product_ids})
+
+    assert response.status_code == 400
+    assert response.get_json() == {
+        "error": "Expected `array` of length <= 1000 - at `$.product_ids`"
+    }
+
+
+def test_create_user_rejects_non_json_body(client):
+    body = '{"name": "a", "email": "a@x", "address": "z"}'
+    response = client.post("/users", data=body, content_type="text/plain")
+
+    assert response.status_code == 415
+
+
+def test_update_product_validates_like_create(client):
+    response = client.put("/products/1", json={"product_name": "p", "price": "2.5"})
+
+    assert response.status_code == 400
+    assert response.get_json() == {
+        "error": "Expected `float`, got `str` - at `$.price`"
+    }
+
+
+def test_remove_product_keeps_product_and_other_orders(client):
+    user_id = create_user(client)
+    product_id = create_product(client)
+    first_order = create_order(client, user_id)
+    second_order = create_order(client, user_id)
+    client.put(f"/orders/{first_order}/add_product/{product_id}")
+    client.put(f"/orders/{second_order}/add_product/{product_id}")
+
+    response = client.delete(f"/orders/{first_order}/remove_product/{product_id}")
+
+    assert response.status_code == 200
+    assert client.get(f"/orders/{first_order}/products").get_json() == []
+    assert client.get(f"/products/{product_id}").get_json()["id"] == product_id
+    second_products = client.get(f"/orders/{second_order}/products").get_json()
+    assert [product["id"] for product in second_products] == [product_id]
+
+    response = client.delete(f"/orders/{first_order}/remove_product/{product_id}")
+    assert response.status_code == 404
+
+
+def test_add_products_skips_products_already_in_order(client):
+    order_id = create_order(client, create_user(client))
+    first = create_product(client, "first")
+    second = create_product(client, "second")
+    client.put(f"/orders/{order_id}/add_product/{first}")
+
+    response = client.put(
+        f"/orders/{order_id}/add_products", json={"product_ids": [first, second]}
+    )
+
+    assert response.get_json() == {"message": "Successfully added 1 products to order!"}
+    products = client.get(f"/orders/{order_id}/products").get_json()
+    assert sorted(product["id"] for product in products) == [first, second]
+
+
+def test_update_and_delete_missing_rows_return_404(client):
+    user = {"name": "a", "email": "a@example.com", "address": "1 Main St"}
+    product = {"product_name": "widget", "price": 2.5}
+
+    assert client.put("/users/99", json=user).status_code == 404
+    assert client.delete("/users/99").status_code == 404
+    assert client.put("/products/99", json=product).status_code == 404
+    assert client.delete("/products/99").status_code == 404
+
+
+def test_update_product_writes_every_field(client):
+    product_id = create_product(client)
+    body = {"product_name": "gadget", "price": 4.0}
+
+    response = client.put(f"/products/{product_id}", json=body)
+
+    assert response.status_code == 200
+    product = client.get(f"/products/{product_id}").get_json()
+    assert product == {"id": product_id, **body}
+
+
+def test_get_user_etag_changes_on_update(client):
+    user_id = create_user(client)
+    response = client.get(f"/users/{user_id}")
+    etag = response.headers["ETag"]
+
+    assert response.headers["Cache-Control"] == "private, max-age=30"
+    cached = client.get(f"/users/{user_id}", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+
+    body = {"name": "b", "email": "a@example.com", "address": "1 Main St"}
+    client.put(f"/users/{user_id}", json=body)
+    response = client.get(f"/users/{user_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_json()["name"] == "b"
+
+
+def test_get_products_etag_changes_on_insert(client):
+    create_product(client)
+    response = client.get("/products")
+    etag = response.headers["ETag"]
+
+    assert response.headers["Cache-Control"] == "public, max-age=30"
+    cached = client.get("/products", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+
+    create_product(client, "another")
+    response = client.get("/products", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.get_json()) == 2
+
+
+def test_product_cache_cleared_on_update_and_delete(client, monkeypatch):
+    monkeypatch.setattr(app_module, "PRODUCT_CACHE", True)
+    product_id = create_product(client)
+    assert client.get(f"/products/{product_id}").get_json()["price"] == 2.5
+
+    client.put(f"/products/{product_id}", json={"product_name": "w", "price": 3.0})
+    assert client.get(f"/products/{product_id}").get_json()["price"] == 3.0
+
+    client.delete(f"/products/{product_id}")
+    assert client.get(f"/products/{product_id}").get_json() == {}
+
+
+def test_get_order_products_missing_order_vs_empty_order(client):
+    order_id = create_order(client, create_user(client))
+
+    assert client.get(f"/orders/{order_id}/products").get_json() == []
+    assert client.get("/orders/99/products").status_code == 404